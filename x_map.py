@@ -5,21 +5,34 @@ __version__ = '0.0.3'
 __author__ = 'Maximilian Singh'
 __copyright__ = 'Maximilian Singh'
 
+import logging
+
 import smopy
 import numpy as np
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+
+logger = logging.getLogger(__name__)
 
+# Values are mapped to colormap positions by dividing by this scale, so
+# 0 maps to the start and -100 to the end of the plasma colormap.
+_VALUE_SCALE = -100
 
 
-def calculate_bounding_coordinates(data, extend_percentage):
+
+def calculate_bounding_coordinates(lats, longs, extend_percentage):
     """Calculate the bounding box for given coordinates.
 
     Parameters
     ----------
-    data : array_like
-        Column 0 should be latitude coordinates and column 1 should be
-        longitude coordinates
+    lats : array_like
+        Latitude coordinates.
+    longs : array_like
+        Longitude coordinates.
     extend_percentage : int, float
         Determines how much the shown map is extended around the
         bounding box of the values.  Given in percent of the bounding
@@ -27,8 +40,8 @@ def calculate_bounding_coordinates(data, extend_percentage):
 
     """
     # Get minimum and maximum latitude and longitude for bounding box.
-    lat_long_min = np.array([data[:, 0].min(), data[:, 1].min()])
-    lat_long_max = np.array([data[:, 0].max(), data[:, 1].max()])
+    lat_long_min = np.array([np.min(lats), np.min(longs)])
+    lat_long_max = np.array([np.max(lats), np.max(longs)])
 
     # Extend bounding box by extend_percentage in each direction.
     lat_long_extend = (lat_long_max - lat_long_min) * extend_percentage / 100
@@ -57,11 +70,12 @@ def calculate_optimal_zoom(lat_long_min, lat_long_max, min_size_px):
     # Get minimum and maximum tile coordinates of bounding box.
     ## min -> max[0], min[1] because of mercator projection:
     ## http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
-    min_loc = np.array(smopy.deg2num(lat_long_max[0], lat_long_min[1], 0, do_round=False))
-    max_loc = np.array(smopy.deg2num(lat_long_min[0], lat_long_max[1], 0, do_round=False))
+    ## Both corners are projected in a single call.
+    x, y = smopy.deg2num(np.array([lat_long_max[0], lat_long_min[0]]),
+                         np.array([lat_long_min[1], lat_long_max[1]]), 0, do_round=False)
 
     # Calculate distance in x and y direction.
-    dist = max_loc - min_loc
+    dist = np.array([x[1] - x[0], y[1] - y[0]])
 
     # Calculate minimal necessary zoom level.
     ## Refer to http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
@@ -72,6 +86,178 @@ def calculate_optimal_zoom(lat_long_min, lat_long_max, min_size_px):
 
 
 
+def _prepare(data, min_size_px, extend_percentage):
+    """Fetch the map and project the coordinates to pixels.
+
+    This is the work shared by all value columns of `plot`.
+
+    Parameters
+    ----------
+    data : ndarray
+        Column 0 should be latitude coordinates and column 1 should be
+        longitude coordinates.
+    min_size_px : int
+        Minimum number of pixels in each dimension of the map.
+    extend_percentage : int, float
+        Determines how much the map is extended around the bounding
+        box of the values.  Given in percent of the bounding box
+        extents.
+
+    Returns
+    -------
+    m : smopy.Map
+        The fetched map.
+    xs, ys : ndarray
+        Pixel coordinates of the data.
+    x_min, y_min, x_max, y_max : float
+        Pixel limits of the extended bounding box.
+
+    """
+    # Split coordinates into contiguous arrays.
+    ## Bounding box and projection then run on contiguous memory instead
+    ## of strided columns.  They are kept at float64 because the pixel
+    ## projection at high zoom levels needs the precision.
+    lats = np.ascontiguousarray(data[:, 0], dtype=np.float64)
+    longs = np.ascontiguousarray(data[:, 1], dtype=np.float64)
+
+    # Calculate bounding box and zoom.
+    lat_long_min, lat_long_max = calculate_bounding_coordinates(lats, longs, extend_percentage=extend_percentage)
+    zoom = calculate_optimal_zoom(lat_long_min, lat_long_max, min_size_px)
+
+    # Get map data from OpenStreetMaps.
+    m = smopy.Map((*lat_long_min, *lat_long_max), z=zoom)
+
+    # Project all coordinates to pixels at once.
+    xs, ys = m.to_pixels(lats, longs)
+
+    # Get the extended bounding box in pixels.
+    ## Both corners are projected in a single call.
+    ## min -> max[0], min[1] because of mercator projection.
+    (x_min, x_max), (y_min, y_max) = m.to_pixels(np.array([lat_long_max[0], lat_long_min[0]]),
+                                                 np.array([lat_long_min[1], lat_long_max[1]]))
+
+    return m, xs, ys, x_min, y_min, x_max, y_max
+
+
+
+def _gradient_pieces(xs, ys):
+    """Split the lines between consecutive points into pieces.
+
+    Each line is split into one piece per pixel along its major axis,
+    like a Bresenham line.  The pieces of all lines are built in a
+    single pass from the line index and position of each piece.
+
+    Parameters
+    ----------
+    xs, ys : ndarray
+        Pixel coordinates of the points.
+
+    Returns
+    -------
+    segments : ndarray
+        Start and end point of each piece, shape (pieces, 2, 2).
+    line_index : ndarray
+        Index of the line each piece belongs to.
+    t_mid : ndarray
+        Position of the center of each piece along its line, from 0 to
+        1.
+
+    """
+    dx = np.diff(xs)
+    dy = np.diff(ys)
+
+    # Calculate number of pieces per line.
+    ## Lines between identical locations get no pieces, so every piece
+    ## belongs to a line with a nonzero piece count.
+    counts = np.ceil(np.maximum(np.abs(dx), np.abs(dy))).astype(np.int64)
+    line_index = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    t_start = step / counts[line_index]
+    t_end = (step + 1) / counts[line_index]
+
+    # Pieces run from one interpolated point to the next.
+    segments = np.empty((len(line_index), 2, 2))
+    segments[:, 0, 0] = xs[line_index] + t_start * dx[line_index]
+    segments[:, 0, 1] = ys[line_index] + t_start * dy[line_index]
+    segments[:, 1, 0] = xs[line_index] + t_end * dx[line_index]
+    segments[:, 1, 1] = ys[line_index] + t_end * dy[line_index]
+
+    return segments, line_index, (t_start + t_end) / 2
+
+
+
+def _value_colors(norm_values, palette):
+    """Map normalized values to colors of the given palette.
+
+    Normalized values from 0 to 1 are quantized to the palette the same
+    way the colormap itself does, so indexing replaces calling the
+    colormap for every value.  Like in the colormap, infinite values get
+    the end colors and NaN values get the transparent bad color.
+
+    """
+    n = len(palette)
+    # Clip before casting, so infinite values do not overflow.
+    positions = np.clip(norm_values * n, 0, n - 1)
+    bad = np.isnan(positions)
+    positions[bad] = 0
+    colors = palette[positions.astype(np.int32)]
+    colors[bad] = cm.plasma.get_bad()
+    return colors
+
+
+
+def _render_column(ax, xs, ys, values, pieces, markers, palette):
+    """Plot gradient lines and markers of one value column.
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes showing the map.
+    xs, ys : ndarray
+        Pixel coordinates of the values.
+    values : ndarray
+        Values of this column.
+    pieces : tuple
+        Gradient line pieces as returned by `_gradient_pieces`.  If
+        `None`, no gradient lines are plotted.
+    markers : bool
+        If `True`, markers for each value are plotted.
+    palette : ndarray
+        RGBA colors normalized values are mapped to.
+
+    Returns
+    -------
+    overlays : list
+        The added artists.
+
+    """
+    overlays = []
+
+    # Normalize values once for markers and gradient lines.
+    norm_values = values / _VALUE_SCALE
+
+    # Plot gradient lines.
+    if pieces is not None:
+        segments, line_index, t_mid = pieces
+        # Pieces are colored by the value at their center.
+        segment_values = norm_values[line_index] + t_mid * np.diff(norm_values)[line_index]
+        lc = LineCollection(segments, colors=_value_colors(segment_values, palette), zorder=1)
+        lc.set_linewidth(2)
+        lc.set_rasterized(True)
+        overlays.append(ax.add_collection(lc))
+
+    # Plot markers.
+    ## A single scatter call creates one artist for all markers.
+    ## Markers and lines are rasterized, so vector output formats embed
+    ## one image instead of one path per marker or piece.
+    if markers:
+        overlays.append(ax.scatter(xs, ys, c=_value_colors(norm_values, palette), marker='o', s=100,
+                                   edgecolor='face', zorder=1, rasterized=True))
+
+    return overlays
+
+
+
 def plot(data, min_size_px=512, extend_percentage=10, filename=False,
          markers=True, gradient_lines=True, caption=False,
          show_plot=True):
@@ -108,58 +294,50 @@ def plot(data, min_size_px=512, extend_percentage=10, filename=False,
         `True`.
 
     """
-    # Calculate bounding box and zoom.
-    lat_long_min, lat_long_max = calculate_bounding_coordinates(data, extend_percentage=extend_percentage)
-    zoom = calculate_optimal_zoom(lat_long_min, lat_long_max, min_size_px)
-
-    # Get map data from OpenStreetMaps.
-    dpi = 72
-    m = smopy.Map((*lat_long_min, *lat_long_max), z=zoom)
+    # Fetch map and project coordinates once for all value columns.
+    data = np.asarray(data)
+    m, xs, ys, x_min, y_min, x_max, y_max = _prepare(data, min_size_px, extend_percentage)
 
     # Calculate resulting figure size.
+    dpi = 72
     size = m.to_pil().size
-    print(size)
+    logger.debug("size=%s", size)
     figsize = (10/32 + size[0] / dpi, 10/32 + size[1] / dpi)
 
-    # Plot map and data for each value column.
-    for value_index in range(2, data.shape[1]):
-        # Convert map to matplotlib.
-        ax = m.show_mpl(figsize=figsize, dpi=dpi)
-
-
-        # Plot markers and gradient lines for each value.
-        for i, (lat, long, value) in enumerate(data[:,(0, 1, value_index)]):
-            loc_px = m.to_pixels(lat, long)
+    # Calculate gradient line pieces.
+    pieces = _gradient_pieces(xs, ys) if gradient_lines else None
 
-            # Plot markers.
-            if markers:
-                ax.plot(*loc_px, 'o', color=cm.plasma(float(-value / 100)), markersize=10)
+    # Set up the palette shared by markers and gradient lines.
+    palette = cm.plasma(np.arange(cm.plasma.N))
 
-            # Plot gradient lines.
-            ## Skip first value and then plot line from last value to current value.
-            if i != 0 and gradient_lines:
-                # Calculate line length.
-                line_length = np.sqrt((last_loc_px[0] - loc_px[0]) ** 2 + (last_loc_px[1] - loc_px[1]) ** 2)
-                # Calculate x and y coordinates of line points.
-                x = np.linspace(last_loc_px[0], loc_px[0], line_length)
-                y = (loc_px[1] - last_loc_px[1]) * ((x - last_loc_px[0]) / (loc_px[0] - last_loc_px[0])) + last_loc_px[1]
-                # Generate a gradient color map.
-                colors = [cm.plasma(float(-((value - last_value) * i / len(x) + last_value) / 100)) for i in range(len(x))]
-                # Gradient lines are generated using scatter plots.
-                ax.scatter(x, y, c=colors, marker='o', s=1, edgecolor='face')
-
-            # Store last location and value for next gradient line.
-            last_loc_px = loc_px
-            last_value = value
+    # Convert map image to an array once.
+    img = np.asarray(m.to_pil())
 
+    # Plot map and data for each value column.
+    fig = None
+    for value_index in range(2, data.shape[1]):
+        # Convert map to matplotlib.
+        ## Shown figures are handed over to pyplot, so each value column
+        ## needs its own figure then.  Otherwise one figure is drawn by
+        ## Agg directly, without pyplot or a GUI backend, and reused with
+        ## only the data overlays replaced.
+        if fig is None or show_plot:
+            if show_plot:
+                fig = plt.figure(figsize=figsize, dpi=dpi)
+            else:
+                fig = Figure(figsize=figsize, dpi=dpi)
+                FigureCanvasAgg(fig)
+            ax = fig.add_subplot(111)
+            ax.set_axis_off()
+            fig.tight_layout()
+            ax.imshow(img)
 
-        # Get the extended bounding box in pixels.
-        x_min, y_min = m.to_pixels(lat_long_max[0], lat_long_min[1])
-        x_max, y_max = m.to_pixels(lat_long_min[0], lat_long_max[1])
+            # Set the axes limits to show only the extended bounding box.
+            ax.set_xlim(x_min, x_max)
+            ax.set_ylim(y_max, y_min)
 
-        # Set the axes limits to show only the extended bounding box.
-        ax.set_xlim(x_min, x_max)
-        ax.set_ylim(y_max, y_min)
+        # Plot gradient lines and markers.
+        overlays = _render_column(ax, xs, ys, data[:, value_index], pieces, markers, palette)
 
         # Add caption to the plot.
         if caption is not False:
@@ -167,7 +345,8 @@ def plot(data, min_size_px=512, extend_percentage=10, filename=False,
                 this_caption = caption
             else:
                 this_caption = caption[value_index - 2]
-            ax.text(10 + x_min, y_max - 10, this_caption, fontsize=48, fontdict={'weight': 'bold'})
+            overlays.append(ax.text(10 + x_min, y_max - 10, this_caption, fontsize=48,
+                                    fontdict={'weight': 'bold'}))
 
         # Save plot if filename is given.
         if filename is not False:
@@ -175,11 +354,12 @@ def plot(data, min_size_px=512, extend_percentage=10, filename=False,
                 this_filename = filename
             else:
                 this_filename = filename[value_index - 2]
-            plt.savefig(this_filename, pad_inches=0, bbox_inches='tight', dpi=dpi)
+            fig.savefig(this_filename, pad_inches=0, bbox_inches='tight', dpi=dpi)
 
-        # Show plot if requested.
+        # Show and close plot if requested, otherwise clear it for reuse.
         if show_plot:
             plt.show()
-
-        # Close plot.
-        plt.close()
+            plt.close(fig)
+        else:
+            for artist in overlays:
+                artist.remove()